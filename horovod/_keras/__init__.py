@@ -13,10 +13,14 @@
 # limitations under the License.
 # ==============================================================================
 
+import collections
 import json
+import numbers
 import os
 import threading
 
+import numpy as np
+
 import horovod.tensorflow as hvd
 import tensorflow as tf
 from horovod.common.gradient_aggregation import LocalGradientAggregationHelper
@@ -24,7 +28,42 @@ from horovod.common.gradient_aggregation_eager import LocalGradientAggregationHe
 from horovod.common.tf_profile import TFProfileHelper
 
 
-def _make_allreduce_grads_fn(name_scope, sparse_as_dense, device_dense, device_sparse, compression):
+class _AdaptiveCompression(object):
+    """Applies `compression` only to tensors of at least `threshold` bytes.
+
+    For small tensors the cost of compressing and decompressing outweighs the
+    savings in communication, so they are sent unmodified.
+    """
+    def __init__(self, compression, threshold):
+        self._compression = compression
+        self._threshold = threshold
+
+    def _should_compress(self, tensor):
+        num_elements = tensor.shape.num_elements()
+        if num_elements is None:
+            # The size is only known at runtime, and the compressed dtype must be
+            # fixed when the graph is built, so fall back to compressing.
+            return True
+        return num_elements * tensor.dtype.size >= self._threshold
+
+    def compress(self, tensor):
+        if self._should_compress(tensor):
+            tensor_compressed, ctx = self._compression.compress(tensor)
+            return tensor_compressed, (True, ctx)
+        return tensor, (False, None)
+
+    def decompress(self, tensor, ctx):
+        compressed, ctx = ctx
+        if compressed:
+            return self._compression.decompress(tensor, ctx)
+        return tensor
+
+
+def _make_allreduce_grads_fn(name_scope, sparse_as_dense, device_dense, device_sparse, compression,
+                             compression_threshold=0):
+    if compression_threshold > 0 and compression is not hvd.Compression.none:
+        compression = _AdaptiveCompression(compression, compression_threshold)
+
     def allreduce_grads(gradients):
         averaged_gradients = []
         with tf.name_scope(name_scope):
@@ -45,109 +84,147 @@ def _make_allreduce_grads_fn(name_scope, sparse_as_dense, device_dense, device_s
     return allreduce_grads
 
 
-def create_distributed_optimizer(keras, optimizer, name, device_dense, device_sparse,
-                                 compression, sparse_as_dense, aggregation_frequency,
-                                 grad_updated_sizes_dict, profile_frequency, profile_filename,
-                                 average_aggregated_gradients):
-    class _DistributedOptimizer(keras.optimizers.Optimizer):
-        _HAS_AGGREGATE_GRAD = True
-
-        def __init__(self, **kwargs):
-            self._name = name or "Distributed%s" % self.__class__.__base__.__name__
-            self._device_dense = device_dense
-            self._device_sparse = device_sparse
-            self._compression = compression
-            self._sparse_as_dense = sparse_as_dense
-            self._aggregated_gradients = False
-
-            # We save the result of this because `get_gradients` and
-            # `apply_gradients` do not execute eagerly.
-            self._executing_eagerly = hvd._executing_eagerly()
-
-            allreduced_grads_fn = _make_allreduce_grads_fn(
-                self._name + "_Allreduce",
-                self._sparse_as_dense,
-                self._device_dense,
-                self._device_sparse,
-                self._compression
+_DistributedOptimizerConfig = collections.namedtuple(
+    '_DistributedOptimizerConfig',
+    ['name', 'device_dense', 'device_sparse', 'compression', 'sparse_as_dense',
+     'aggregation_frequency', 'grad_updated_sizes_dict', 'profile_frequency',
+     'profile_filename', 'average_aggregated_gradients', 'compression_threshold'])
+
+
+class _DistributedOptimizerMixin(object):
+    """Overrides the gradient methods of a Keras optimizer to allreduce gradients.
+
+    Classes created by `create_distributed_optimizer` put this mixin in front of
+    the wrapped optimizer class and provide their settings as `_hvd_cfg`, along
+    with the wrapped class's `get_gradients` and `apply_gradients` as
+    `_base_get_gradients` and `_base_apply_gradients`.
+    """
+    _HAS_AGGREGATE_GRAD = True
+
+    def __init__(self, **kwargs):
+        cfg = self._hvd_cfg
+        self._name = cfg.name
+        self._device_dense = cfg.device_dense
+        self._device_sparse = cfg.device_sparse
+        self._compression = cfg.compression
+        self._sparse_as_dense = cfg.sparse_as_dense
+        self._aggregated_gradients = False
+
+        # We save the result of this because `get_gradients` and
+        # `apply_gradients` do not execute eagerly.
+        self._executing_eagerly = hvd._executing_eagerly()
+
+        allreduced_grads_fn = _make_allreduce_grads_fn(
+            self._name + "_Allreduce",
+            self._sparse_as_dense,
+            self._device_dense,
+            self._device_sparse,
+            self._compression,
+            cfg.compression_threshold
+        )
+        if not self._executing_eagerly:
+            self._agg_helper = LocalGradientAggregationHelper(
+                cfg.aggregation_frequency,
+                allreduced_grads_fn,
+                cfg.sparse_as_dense,
+                cfg.grad_updated_sizes_dict,
+                cfg.average_aggregated_gradients
+            )
+            self._profile_helper = TFProfileHelper(cfg.profile_frequency, cfg.profile_filename)
+        else:
+            self._agg_helper = LocalGradientAggregationHelperEager(
+                cfg.aggregation_frequency,
+                allreduced_grads_fn,
+                cfg.sparse_as_dense,
+                cfg.average_aggregated_gradients
             )
-            if not self._executing_eagerly:
-                self._agg_helper = LocalGradientAggregationHelper(
-                    aggregation_frequency,
-                    allreduced_grads_fn,
-                    sparse_as_dense,
-                    grad_updated_sizes_dict,
-                    average_aggregated_gradients
-                )
-                self._profile_helper = TFProfileHelper(profile_frequency, profile_filename)
-            else:
-                self._agg_helper = LocalGradientAggregationHelperEager(
-                    aggregation_frequency,
-                    allreduced_grads_fn,
-                    sparse_as_dense,
-                    average_aggregated_gradients
-                )
 
-            super(self.__class__, self).__init__(**kwargs)
+        super(_DistributedOptimizerMixin, self).__init__(**kwargs)
 
-        def get_gradients(self, loss, params):
-            """
-            Compute gradients of all trainable variables.
+    def get_gradients(self, loss, params):
+        """
+        Compute gradients of all trainable variables.
 
-            See Optimizer.get_gradients() for more info.
+        See Optimizer.get_gradients() for more info.
 
-            In DistributedOptimizer, get_gradients() is overriden to also
-            allreduce the gradients before returning them.
-            """
-            self.grads = super(self.__class__, self).get_gradients(loss, params)
-            return self._allreduce()
+        In DistributedOptimizer, get_gradients() is overriden to also
+        allreduce the gradients before returning them.
+        """
+        self.grads = type(self)._base_get_gradients(self, loss, params)
+        return self._allreduce()
 
-        def _aggregate_gradients(self, grads_and_vars):
-            self.grads = [grad for grad, var in grads_and_vars]
-            return self._allreduce()
+    def _aggregate_gradients(self, grads_and_vars):
+        self.grads = [grad for grad, var in grads_and_vars]
+        return self._allreduce()
 
-        def _allreduce(self):
-            self._aggregated_gradients = True
+    def _allreduce(self):
+        self._aggregated_gradients = True
 
-            if self._executing_eagerly:
-                if hvd.size() > 1:
-                    return self._agg_helper.compute_gradients(tuple(self.grads))
-                else:
-                    return self.grads
+        if self._executing_eagerly:
+            if hvd.size() > 1:
+                return self._agg_helper.compute_gradients(tuple(self.grads))
             else:
-                if hvd.size() > 1:
-                    self._agg_helper.init_aggregation_vars(
-                        self.grads,
-                        sess=tf.compat.v1.keras.backend.get_session(op_input_list=()),
-                    )
-                    with tf.control_dependencies([self._profile_helper.profile_start()]):
-                        allreduced_grads = self._agg_helper.compute_gradients(tuple(self.grads))
-                    with tf.control_dependencies(allreduced_grads):
-                        comm_end = self._profile_helper.profile_end()
-                    with tf.control_dependencies([comm_end]):
-                        return [tf.identity(grad) for grad in allreduced_grads]
-                else:
-                    return self.grads
-
-        def apply_gradients(self, *args, **kwargs):
-            if not self._aggregated_gradients:
-                raise Exception('`apply_gradients()` was called without a call to '
-                                '`get_gradients()`or `_aggregate_gradients` . If you\'re using '
-                                'TensorFlow 2.0 or 2.1, please specify '
-                                '`experimental_run_tf_function=False` in `compile()`.')
-
-            return self._agg_helper.apply_gradients(
-                lambda: super(self.__class__, self).apply_gradients(*args, **kwargs),
-                *args,
-                **kwargs,
-            )
+                return self.grads
+        else:
+            if hvd.size() > 1:
+                self._agg_helper.init_aggregation_vars(
+                    self.grads,
+                    sess=tf.compat.v1.keras.backend.get_session(op_input_list=()),
+                )
+                with tf.control_dependencies([self._profile_helper.profile_start()]):
+                    allreduced_grads = self._agg_helper.compute_gradients(tuple(self.grads))
+                with tf.control_dependencies(allreduced_grads):
+                    comm_end = self._profile_helper.profile_end()
+                with tf.control_dependencies([comm_end]):
+                    return [tf.identity(grad) for grad in allreduced_grads]
+            else:
+                return self.grads
+
+    def apply_gradients(self, *args, **kwargs):
+        if not self._aggregated_gradients:
+            raise Exception('`apply_gradients()` was called without a call to '
+                            '`get_gradients()`or `_aggregate_gradients` . If you\'re using '
+                            'TensorFlow 2.0 or 2.1, please specify '
+                            '`experimental_run_tf_function=False` in `compile()`.')
+
+        return self._agg_helper.apply_gradients(
+            lambda: type(self)._base_apply_gradients(self, *args, **kwargs),
+            *args,
+            **kwargs,
+        )
+
+
+def create_distributed_optimizer(keras, optimizer, name, device_dense, device_sparse,
+                                 compression, sparse_as_dense, aggregation_frequency,
+                                 grad_updated_sizes_dict, profile_frequency, profile_filename,
+                                 average_aggregated_gradients, compression_threshold=2**16):
+    if not isinstance(compression_threshold, numbers.Integral) or compression_threshold < 0:
+        raise ValueError('compression_threshold must be a non-negative integer number of bytes, '
+                         'got %r.' % (compression_threshold,))
+
+    cfg = _DistributedOptimizerConfig(
+        name=name or "Distributed%s" % optimizer.__class__.__name__,
+        device_dense=device_dense,
+        device_sparse=device_sparse,
+        compression=compression,
+        sparse_as_dense=sparse_as_dense,
+        aggregation_frequency=aggregation_frequency,
+        grad_updated_sizes_dict=grad_updated_sizes_dict,
+        profile_frequency=profile_frequency,
+        profile_filename=profile_filename,
+        average_aggregated_gradients=average_aggregated_gradients,
+        compression_threshold=compression_threshold,
+    )
 
     # We dynamically create a new class that inherits from the optimizer that was passed in.
     # The goal is to override get_gradients() method with an allreduce implementation.
     # This class will have the same name as the optimizer it's wrapping, so that the saved
     # model could be easily restored without Horovod.
-    cls = type(optimizer.__class__.__name__, (optimizer.__class__,),
-               dict(_DistributedOptimizer.__dict__))
+    cls = type(optimizer.__class__.__name__, (_DistributedOptimizerMixin, optimizer.__class__),
+               {'_hvd_cfg': cfg,
+                # Resolved once here so the per-step calls skip the super() lookup.
+                '_base_get_gradients': optimizer.__class__.get_gradients,
+                '_base_apply_gradients': optimizer.__class__.apply_gradients})
     return cls.from_config(optimizer.get_config())
 
 
@@ -163,23 +240,94 @@ if hasattr(hvd, 'broadcast_global_variables'):
         return _eval(backend, hvd.broadcast_global_variables(root_rank))
 
 
+try:
+    _placeholder = tf.placeholder
+except AttributeError:
+    _placeholder = tf.compat.v1.placeholder
+
+
+def _value_dtype(value):
+    # Infer the dtype the same way tf.constant does: NumPy values keep their
+    # dtype, while Python scalars and lists prefer 32-bit types when lossless.
+    if isinstance(value, (np.ndarray, np.generic)):
+        return tf.as_dtype(value.dtype)
+    array = np.asarray(value)
+    if array.dtype == np.float64:
+        return tf.float32
+    if array.dtype == np.int64 and np.array_equal(array.astype(np.int32), array):
+        return tf.int32
+    return tf.as_dtype(array.dtype)
+
+
+def _cached_eval(backend, op_key, value, name, make_op, dynamic_first_dim=False):
+    if hvd._executing_eagerly():
+        return make_op(tf.constant(value, name=name))
+
+    # Repeated graph-mode calls reuse a placeholder and op built once per
+    # (op_key, dtype, shape, name) instead of adding new constants to the graph
+    # on every call. The cache lives on the graph so it is released with it.
+    #
+    # Horovod matches ops across ranks by name, and the graph uniquifies names in
+    # creation order, so every rank must build the same sequence of placeholders.
+    # Values whose first dimension may differ across ranks (allgather) therefore
+    # leave it unspecified rather than keying the cache on it.
+    session = backend.get_session()
+    graph = session.graph
+    op_cache = getattr(graph, '_hvd_op_cache', None)
+    if op_cache is None:
+        op_cache = {}
+        graph._hvd_op_cache = op_cache
+
+    dtype = _value_dtype(value)
+    shape = np.shape(value)
+    if dynamic_first_dim and shape:
+        shape = (None,) + shape[1:]
+    key = (op_key, dtype, shape, name)
+    if key not in op_cache:
+        with graph.as_default():
+            placeholder = _placeholder(dtype, shape=shape, name=name)
+            op_cache[key] = (placeholder, make_op(placeholder))
+    placeholder, op = op_cache[key]
+    return session.run(op, feed_dict={placeholder: value})
+
+
 def allreduce(backend, value, name, average):
-    return _eval(backend, hvd.allreduce(tf.constant(value, name=name), average=average))
+    return _cached_eval(backend, ('allreduce', average), value, name,
+                        lambda tensor: hvd.allreduce(tensor, average=average))
 
 
 def allgather(backend, value, name):
-    return _eval(backend, hvd.allgather(tf.constant(value, name=name)))
+    return _cached_eval(backend, ('allgather',), value, name,
+                        lambda tensor: hvd.allgather(tensor), dynamic_first_dim=True)
 
 
 def broadcast(backend, value, root_rank, name):
-    return _eval(backend, hvd.broadcast(tf.constant(value, name=name), root_rank))
+    return _cached_eval(backend, ('broadcast', root_rank), value, name,
+                        lambda tensor: hvd.broadcast(tensor, root_rank))
+
+
+# Maps (id(keras), optimizer modules) to the stock optimizer classes found in them.
+# Only the classes are cached: `wrap_optimizer` closes over per-call arguments such
+# as `compression`, so the wrappers themselves are rebuilt on every load.
+_optimizer_subclasses_cache = {}
+
+
+def _get_optimizer_subclasses(keras, optimizer_modules):
+    key = (id(keras), tuple(sorted(optimizer_modules)))
+    if key not in _optimizer_subclasses_cache:
+        modules = set(optimizer_modules)
+        _optimizer_subclasses_cache[key] = [
+            subclass
+            for subclass in keras.optimizers.Optimizer.__subclasses__()
+            if subclass.__module__ in modules
+        ]
+    return _optimizer_subclasses_cache[key]
 
 
 def load_model(keras, wrap_optimizer, optimizer_modules, filepath, custom_optimizers, custom_objects):
     horovod_objects = {
         subclass.__name__.lower(): wrap_optimizer(subclass)
-        for subclass in keras.optimizers.Optimizer.__subclasses__()
-        if subclass.__module__ in optimizer_modules
+        for subclass in _get_optimizer_subclasses(keras, optimizer_modules)
     }
 
     if custom_optimizers is not None:
@@ -54,7 +54,8 @@ def DistributedOptimizer(optimizer, name=None,
                          compression=Compression.none,
                          sparse_as_dense=False, aggregation_frequency=1,
                          grad_updated_sizes_dict=None, profile_frequency=0,
-                         profile_filename=None, average_aggregated_gradients=False):
+                         profile_filename=None, average_aggregated_gradients=False,
+                         compression_threshold=2**16):
     """
     An optimizer that wraps another keras.optimizers.Optimizer, using an allreduce to
     average gradient values before applying gradients to model weights.
@@ -85,6 +86,11 @@ def DistributedOptimizer(optimizer, name=None,
         average_aggregated_gradients: Whether to average the aggregated gradients
                                       across the iterations. Only possible for
                                       aggregation_frequency > 1.
+        compression_threshold: Minimum size in bytes of a dense gradient for
+                               `compression` to be applied to it, as a
+                               non-negative integer. Smaller gradients are
+                               sent uncompressed. Set to 0 to compress all
+                               gradients. Defaults to 65536.
         """
     return _impl.create_distributed_optimizer(
         keras=keras,
@@ -98,7 +104,8 @@ def DistributedOptimizer(optimizer, name=None,
         grad_updated_sizes_dict=grad_updated_sizes_dict,
         profile_frequency=profile_frequency,
         profile_filename=profile_filename,
-        average_aggregated_gradients=average_aggregated_gradients
+        average_aggregated_gradients=average_aggregated_gradients,
+        compression_threshold=compression_threshold
     )
 
 
@@ -19,10 +19,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import gc
 import tensorflow as tf
 import numpy as np
 import pytest
 import warnings
+import weakref
 
 from distutils.version import LooseVersion
 if LooseVersion(tf.__version__) >= LooseVersion("1.4.0"):
@@ -33,6 +35,7 @@ else:
     from tensorflow.contrib.keras import backend as K
 
 import horovod.tensorflow.keras as hvd
+import horovod._keras as _impl
 
 from common import temppath
 
@@ -133,6 +136,33 @@ class TfKerasTests(tf.test.TestCase):
             self.assertEqual(K.get_value(opt.lr), K.get_value(new_opt.lr))
             self._check_optimizer_weights(opt, new_opt)
 
+    @pytest.mark.skipif(LooseVersion(tf.__version__) < LooseVersion('1.12.0'), reason='TensorFlow version too low')
+    def test_load_model_compression(self):
+        with self.test_session(config=self.config) as sess:
+            K.set_session(sess)
+
+            opt = keras.optimizers.RMSprop(lr=0.0001)
+            opt = hvd.DistributedOptimizer(opt)
+
+            model = keras.models.Sequential()
+            model.add(keras.layers.Dense(2, input_shape=(3,)))
+            model.compile(loss=keras.losses.MSE, optimizer=opt)
+
+            x = np.random.random((1, 3))
+            y = np.random.random((1, 2))
+            model.train_on_batch(x, y)
+
+            with temppath() as fname:
+                model.save(fname)
+
+                # The cached optimizer lookup must not carry the compression of
+                # one load over to the next.
+                first_model = hvd.load_model(fname, compression=hvd.Compression.none)
+                second_model = hvd.load_model(fname, compression=hvd.Compression.fp16)
+
+            self.assertIs(hvd.Compression.none, first_model.optimizer._compression)
+            self.assertIs(hvd.Compression.fp16, second_model.optimizer._compression)
+
     @pytest.mark.skipif(LooseVersion(tf.__version__) < LooseVersion('1.12.0'), reason='TensorFlow version too low')
     def test_load_model_custom_optimizers(self):
         class TestOptimizer(keras.optimizers.RMSprop):
@@ -293,3 +323,155 @@ class TfKerasTests(tf.test.TestCase):
 
             hopt_copy2 = hopt.__class__.from_config(cfg)
             self.assertEqual(cfg, hopt_copy2.get_config())
+
+    def test_allreduce_reuses_ops(self):
+        with self.test_session(config=self.config) as sess:
+            K.set_session(sess)
+
+            value = np.ones((2, 3), dtype=np.float32)
+            result = hvd.allreduce(value, name='reused_allreduce')
+            self.assertAllClose(value, result)
+
+            num_ops = len(sess.graph.get_operations())
+            for _ in range(3):
+                result = hvd.allreduce(value, name='reused_allreduce')
+                self.assertAllClose(value, result)
+            self.assertEqual(num_ops, len(sess.graph.get_operations()))
+
+    def test_allreduce_python_values(self):
+        with self.test_session(config=self.config) as sess:
+            K.set_session(sess)
+
+            # Python scalars and lists follow tf.constant's dtype inference.
+            result = hvd.allreduce(1.5, average=False)
+            self.assertEqual(np.float32, result.dtype)
+            self.assertAllClose(1.5 * hvd.size(), result)
+
+            result = hvd.allreduce([1, 2, 3], average=False)
+            self.assertEqual(np.int32, result.dtype)
+            self.assertAllEqual(np.array([1, 2, 3]) * hvd.size(), result)
+
+            # Python ints that do not fit in int32 are reduced as int64.
+            result = hvd.allreduce(2 ** 40, average=False)
+            self.assertEqual(np.int64, result.dtype)
+            self.assertEqual(2 ** 40 * hvd.size(), result)
+
+    def test_allgather_varying_first_dim(self):
+        with self.test_session(config=self.config) as sess:
+            K.set_session(sess)
+
+            # Each rank sees a different sequence of first dimensions, which must
+            # still map onto the same Horovod op on every rank.
+            for step in range(3):
+                first_dims = [(rank + step) % 2 + 2 for rank in range(hvd.size())]
+                value = np.full((first_dims[hvd.rank()], 3), hvd.rank(), dtype=np.float32)
+                result = hvd.allgather(value, name='varying_allgather')
+
+                expected = np.concatenate([np.full((dim, 3), rank, dtype=np.float32)
+                                           for rank, dim in enumerate(first_dims)])
+                self.assertAllEqual(expected, result)
+
+    def test_allreduce_cache_released_with_graph(self):
+        K.clear_session()
+        value = np.ones((2, 3), dtype=np.float32)
+        self.assertAllClose(value, hvd.allreduce(value, name='released_allreduce'))
+
+        graph_ref = weakref.ref(K.get_session().graph)
+        K.clear_session()
+        gc.collect()
+        self.assertIsNone(graph_ref())
+
+    def test_adaptive_compression_small_tensor(self):
+        with self.test_session(config=self.config):
+            compression = _impl._AdaptiveCompression(hvd.Compression.fp16, 1024)
+            tensor = tf.ones([16], dtype=tf.float32)
+
+            compressed, ctx = compression.compress(tensor)
+            self.assertIs(tensor, compressed)
+            self.assertEqual((False, None), ctx)
+            self.assertIs(tensor, compression.decompress(compressed, ctx))
+
+    def test_adaptive_compression_large_tensor(self):
+        with self.test_session(config=self.config) as sess:
+            compression = _impl._AdaptiveCompression(hvd.Compression.fp16, 1024)
+            # 256 float32 elements is exactly the 1024 byte threshold.
+            tensor = tf.ones([256], dtype=tf.float32)
+
+            compressed, ctx = compression.compress(tensor)
+            self.assertEqual(tf.float16, compressed.dtype)
+            self.assertEqual((True, tf.float32), ctx)
+
+            decompressed = compression.decompress(compressed, ctx)
+            self.assertEqual(tf.float32, decompressed.dtype)
+            self.assertAllClose(sess.run(tensor), sess.run(decompressed))
+
+    def test_adaptive_compression_unknown_shape(self):
+        with self.test_session(config=self.config):
+            compression = _impl._AdaptiveCompression(hvd.Compression.fp16, 1024)
+            tensor = _impl._placeholder(tf.float32, shape=[None])
+
+            compressed, ctx = compression.compress(tensor)
+            self.assertEqual(tf.float16, compressed.dtype)
+            self.assertEqual((True, tf.float32), ctx)
+
+    def test_compression_threshold_disabled(self):
+        class RecordingCompressor(hvd.Compression.none):
+            compressed = []
+
+            @staticmethod
+            def compress(tensor):
+                RecordingCompressor.compressed.append(tensor)
+                return tensor, None
+
+        with self.test_session(config=self.config):
+            tensor = tf.ones([4], dtype=tf.float32)
+
+            allreduce_grads = _impl._make_allreduce_grads_fn(
+                'threshold_enabled', False, '', '', RecordingCompressor, 2 ** 16)
+            allreduce_grads([tensor])
+            self.assertEqual([], RecordingCompressor.compressed)
+
+            allreduce_grads = _impl._make_allreduce_grads_fn(
+                'threshold_disabled', False, '', '', RecordingCompressor, 0)
+            allreduce_grads([tensor])
+            self.assertEqual(1, len(RecordingCompressor.compressed))
+            self.assertIs(tensor, RecordingCompressor.compressed[0])
+
+    def test_wrap_same_optimizer_twice(self):
+        with self.test_session(config=self.config) as sess:
+            K.set_session(sess)
+
+            opt1 = hvd.DistributedOptimizer(keras.optimizers.Adam(), name='first',
+                                            compression=hvd.Compression.none)
+            opt2 = hvd.DistributedOptimizer(keras.optimizers.Adam(), name='second',
+                                            compression=hvd.Compression.fp16)
+
+            # Each wrapper keeps its own configuration.
+            self.assertIsNot(type(opt1), type(opt2))
+            self.assertEqual('first', opt1._hvd_cfg.name)
+            self.assertEqual('second', opt2._hvd_cfg.name)
+            self.assertIs(hvd.Compression.none, opt1._hvd_cfg.compression)
+            self.assertIs(hvd.Compression.fp16, opt2._hvd_cfg.compression)
+            self.assertIs(hvd.Compression.none, opt1._compression)
+            self.assertIs(hvd.Compression.fp16, opt2._compression)
+
+            # Both classes share the mixin's methods instead of defining their own.
+            for cls in (type(opt1), type(opt2)):
+                self.assertTrue(issubclass(cls, _impl._DistributedOptimizerMixin))
+                self.assertTrue(issubclass(cls, keras.optimizers.Adam))
+                for method in ('__init__', 'get_gradients', 'apply_gradients',
+                               '_aggregate_gradients', '_allreduce'):
+                    self.assertNotIn(method, cls.__dict__)
+                    resolved = next(klass.__dict__[method] for klass in cls.__mro__
+                                    if method in klass.__dict__)
+                    self.assertIs(_impl._DistributedOptimizerMixin.__dict__[method], resolved)
+
+    def test_compression_threshold_validation(self):
+        with self.test_session(config=self.config) as sess:
+            K.set_session(sess)
+
+            for threshold in (None, -1, 1.5):
+                with self.assertRaises(ValueError):
+                    hvd.DistributedOptimizer(keras.optimizers.Adam(),
+                                             compression=hvd.Compression.fp16,
+                                             compression_threshold=threshold)